@@ -103,15 +103,29 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+# Воркер берет по одной задаче за раз, чтобы не держать неподтвержденные задачи
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Запись журнала уведомлений выполняется в отдельной низкоприоритетной очереди
+CELERY_TASK_ROUTES = {
+    'notifications.tasks.record_notification_results': {'queue': 'notifications_audit'},
+}
 
 # Email Configuration
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# SMTP по умолчанию. Для отправки через HTTP API провайдера (django-anymail):
+# EMAIL_BACKEND=anymail.backends.sendgrid.EmailBackend
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
 EMAIL_PORT = int(os.getenv('EMAIL_PORT', 587))
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
-DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+# Таймаут SMTP в секундах, чтобы зависший сервер не блокировал воркер
+EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', 10))
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER)
+
+ANYMAIL = {
+    'SENDGRID_API_KEY': os.getenv('SENDGRID_API_KEY', ''),
+}
 
 # Twilio Configuration
 TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID', '')
@@ -121,6 +135,14 @@ TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER', '')
 # Telegram Configuration
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 
+# Notification channels
+# ПОРЯДОК ВАЖЕН: определяет приоритет каналов. Отключенные каналы не создаются
+NOTIFICATION_CHANNELS = [
+    'telegram',  # Первый приоритет - быстрый и бесплатный
+    'email',     # Второй приоритет - надежный
+    'sms',       # Третий приоритет - гарантированная доставка
+]
+
 # === LOGGING ===
 LOGGING = {
     'version': 1,
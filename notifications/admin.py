@@ -6,4 +6,6 @@ from django.contrib.auth.admin import UserAdmin
 # Register your models here.
 @admin.register(UserProfile)
 class UserProfile(admin.ModelAdmin):
-    list_display = ('user', 'phone_number', 'telegram_chat_id')
\ No newline at end of file
+    list_display = ('user', 'phone_number', 'telegram_chat_id')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
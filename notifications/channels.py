@@ -1,20 +1,172 @@
+import functools
 import logging
+import smtplib
+import threading
+import time
 from abc import ABC, abstractmethod
+from anymail.exceptions import AnymailRecipientsRefused
+from celery.signals import worker_process_shutdown
 from django.conf import settings
 from django.core.mail import send_mail
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
-import requests
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
+SMTP_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+# Общий HTTP/2 клиент для Telegram: одно соединение с api.telegram.org
+# мультиплексирует отправки в рамках процесса воркера
+_TELEGRAM_CLIENT = httpx.Client(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+)
+
+
+@worker_process_shutdown.connect
+def _close_telegram_client(**kwargs):
+    _TELEGRAM_CLIENT.close()
+
+# Токен бота читается из настроек один раз при импорте модуля
+_TELEGRAM_BOT_TOKEN = getattr(settings, 'TELEGRAM_BOT_TOKEN', None)
+_TELEGRAM_URL = f"https://api.telegram.org/bot{_TELEGRAM_BOT_TOKEN}/sendMessage"
+_TELEGRAM_HEADERS = {'Content-Type': 'application/json'}
+
+_TWILIO_CLIENT = None
+
+
+def _get_twilio_client():
+    """Лениво создает и кэширует Twilio клиент (один на процесс воркера)"""
+    global _TWILIO_CLIENT
+    if _TWILIO_CLIENT is None:
+        if (getattr(settings, 'TWILIO_ACCOUNT_SID', None) and
+                getattr(settings, 'TWILIO_AUTH_TOKEN', None)):
+            _TWILIO_CLIENT = Client(
+                settings.TWILIO_ACCOUNT_SID,
+                settings.TWILIO_AUTH_TOKEN
+            )
+            logger.debug("Twilio client initialized")
+        else:
+            logger.warning("Twilio credentials not found")
+    return _TWILIO_CLIENT
+
+
+class CircuitOpenError(Exception):
+    """Канал временно отключен предохранителем"""
+
+
+class ProviderServerError(Exception):
+    """
+    Провайдер ответил ошибкой 5xx. Хранит только код ответа: URL запроса
+    (для Telegram он содержит токен бота) в сообщение не попадает.
+    """
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class EmailNotSentError(Exception):
+    """Email бэкенд принял вызов, но не отправил письмо (например, адрес отклонен)"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель (circuit breaker) для канала уведомлений.
+    После failure_threshold ошибок подряд канал размыкается на reset_timeout секунд,
+    затем пропускает одну пробную отправку (half-open).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failure_count = 0
+        self.last_failure_time = None
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.last_failure_time < self.reset_timeout:
+                    return False
+                # Время ожидания вышло - пропускаем одну пробную отправку
+                self.state = self.HALF_OPEN
+                return True
+            # HALF_OPEN: пробная отправка уже выполняется
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failure_count = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            self.last_failure_time = time.monotonic()
+            if self.state == self.HALF_OPEN or self.failure_count >= self.failure_threshold:
+                self.state = self.OPEN
+
+
+# Предохранители общие для процесса, по одному на канал
+_CIRCUIT_BREAKERS = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def get_circuit_breaker(channel_name) -> CircuitBreaker:
+    with _CIRCUIT_BREAKERS_LOCK:
+        if channel_name not in _CIRCUIT_BREAKERS:
+            _CIRCUIT_BREAKERS[channel_name] = CircuitBreaker()
+        return _CIRCUIT_BREAKERS[channel_name]
+
+
+def circuit_breaker(deliver):
+    """
+    Оборачивает обращение к провайдеру канала предохранителем.
+    Ошибки провайдера определяет _is_provider_error канала; при разомкнутом
+    предохранителе сразу выбрасывается CircuitOpenError.
+    """
+    @functools.wraps(deliver)
+    def wrapper(self, *args, **kwargs):
+        breaker = get_circuit_breaker(self.channel_name)
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"{self.channel_name} circuit is open")
+        try:
+            result = deliver(self, *args, **kwargs)
+        except Exception as e:
+            if self._is_provider_error(e):
+                breaker.record_failure()
+            else:
+                # Провайдер ответил (ошибка относится к получателю) - это тоже
+                # завершает пробную отправку в состоянии half-open
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+    return wrapper
+
+
 class NotificationChannel(ABC):
     """Абстрактный базовый класс для всех каналов уведомлений."""
 
     @abstractmethod
-    def send(self, user, subject, message) -> bool:
+    def send(self, user, profile, content, connection=None) -> bool:
         """
         Attempts to send a notification to the user.
+        profile is the user's UserProfile (or None), loaded once by the caller.
+        content is the channel's message as returned by prepare().
+        connection is an open email connection reused across a batch; channels
+        with process-wide clients (Telegram, Twilio) ignore it.
         Returns True if successful, False otherwise.
         """
         pass
@@ -25,95 +177,129 @@ class NotificationChannel(ABC):
         """Returns the name of the channel."""
         pass
 
-    def _log_success(self, user, details=""):
-        """Логирование успешной отправки"""
-        logger.info(f"✅ {self.channel_name.upper()} SUCCESS for {user.username} {details}")
+    def prepare(self, subject, message):
+        """
+        Formats the message for this channel. Called once per notification
+        (or once per broadcast), the result is passed to send() as content.
+        """
+        return f"{subject}\n{message}" if subject else message
+
+    def is_eligible(self, user, profile) -> bool:
+        """
+        Cheap check that the channel is configured and the user has an address for it.
+        Ineligible channels are skipped without attempting a send.
+        """
+        return True
+
+    def _is_provider_error(self, error) -> bool:
+        """Считается ли исключение отказом провайдера (для предохранителя)"""
+        return True
+
+    def _log_success(self, user, details="", *args):
+        """Логирование успешной отправки (details - формат для args)"""
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s SUCCESS for %s " + details, self.channel_name.upper(), user.username, *args)
 
     def _log_failure(self, user, reason=""):
         """Логирование неудачной отправки"""
-        logger.warning(f"❌ {self.channel_name.upper()} FAILED for {user.username}: {reason}")
+        logger.warning("%s FAILED for %s: %s", self.channel_name.upper(), user.username, reason)
 
     def _log_error(self, user, error):
         """Логирование ошибки"""
-        logger.error(f"💥 {self.channel_name.upper()} ERROR for {user.username}: {error}")
+        logger.error("%s ERROR for %s: %s", self.channel_name.upper(), user.username, error)
 
 class EmailChannel(NotificationChannel):
-    def send(self, user, subject, message) -> bool:
+    def send(self, user, profile, content, connection=None) -> bool:
         if not user.email:
             self._log_failure(user, "no email address")
             return False
         
         try:
             # Проверяем настройки email
-            if not all([
-                settings.EMAIL_HOST_USER,
-                settings.EMAIL_HOST_PASSWORD,
-                settings.EMAIL_HOST
-            ]):
+            if not self._is_configured():
                 self._log_failure(user, "email settings not configured")
                 return False
             
-            logger.debug(f"📧 Preparing to send email to {user.email}")
+            logger.debug("Preparing to send email to %s", user.email)
             
-            send_mail(
-                subject=subject,
-                message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email],
-                fail_silently=False,
-            )
+            subject, message = content
+            self._deliver(user, subject, message, connection)
             
-            self._log_success(user, f"to {user.email}")
+            self._log_success(user, "to %s", user.email)
             return True
             
+        except CircuitOpenError:
+            self._log_failure(user, "circuit breaker is open")
+            return False
         except Exception as e:
             self._log_error(user, str(e))
             return False
 
+    def prepare(self, subject, message):
+        return (subject, message)
+
+    def is_eligible(self, user, profile) -> bool:
+        return bool(user.email) and self._is_configured()
+
+    def _is_configured(self) -> bool:
+        # Учетные данные SMTP нужны только SMTP-бэкенду; HTTP API бэкенды (anymail)
+        # настраиваются через ANYMAIL
+        if settings.EMAIL_BACKEND == SMTP_EMAIL_BACKEND:
+            return bool(
+                settings.EMAIL_HOST_USER and
+                settings.EMAIL_HOST_PASSWORD and
+                settings.EMAIL_HOST
+            )
+        return bool(settings.DEFAULT_FROM_EMAIL)
+
+    def _is_provider_error(self, error) -> bool:
+        # Отклоненный адрес получателя не означает недоступность почтового сервера
+        return not isinstance(
+            error, (smtplib.SMTPRecipientsRefused, AnymailRecipientsRefused, EmailNotSentError)
+        )
+
+    @circuit_breaker
+    def _deliver(self, user, subject, message, connection=None):
+        sent = send_mail(
+            subject=subject,
+            message=message,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[user.email],
+            fail_silently=False,
+            connection=connection,
+        )
+        # Переданное соединение могло быть открыто с fail_silently=True
+        if not sent:
+            raise EmailNotSentError("email backend did not send the message")
+
     @property
     def channel_name(self):
         return "email"
 
 class TwilioSMSChannel(NotificationChannel):
     def __init__(self):
-        self.client = None
-        if (hasattr(settings, 'TWILIO_ACCOUNT_SID') and 
-            hasattr(settings, 'TWILIO_AUTH_TOKEN') and
-            settings.TWILIO_ACCOUNT_SID and settings.TWILIO_AUTH_TOKEN):
-            
-            self.client = Client(
-                settings.TWILIO_ACCOUNT_SID, 
-                settings.TWILIO_AUTH_TOKEN
-            )
-            logger.debug("Twilio client initialized")
-        else:
-            logger.warning("Twilio credentials not found")
+        self.client = _get_twilio_client()
 
-    def send(self, user, subject, message) -> bool:
+    def send(self, user, profile, content, connection=None) -> bool:
         if not self.client:
             self._log_failure(user, "Twilio client not configured")
             return False
 
-        from .models import UserProfile
-        profile = getattr(user, 'userprofile', None)
         if not profile or not profile.phone_number:
             self._log_failure(user, "no phone number")
             return False
         
         try:
-            full_message = f"{subject}\n{message}" if subject else message
-            
-            logger.debug(f"📱 Preparing to send SMS to {profile.phone_number}")
+            logger.debug("Preparing to send SMS to %s", profile.phone_number)
             
-            twilio_message = self.client.messages.create(
-                body=full_message,
-                from_=settings.TWILIO_PHONE_NUMBER,
-                to=profile.phone_number
-            )
+            twilio_message = self._deliver(profile.phone_number, content)
             
-            self._log_success(user, f"to {profile.phone_number} (SID: {twilio_message.sid})")
+            self._log_success(user, "to %s (SID: %s)", profile.phone_number, twilio_message.sid)
             return True
             
+        except CircuitOpenError:
+            self._log_failure(user, "circuit breaker is open")
+            return False
         except TwilioRestException as e:
             self._log_error(user, f"Twilio error {e.code}: {e.msg}")
             return False
@@ -121,53 +307,99 @@ class TwilioSMSChannel(NotificationChannel):
             self._log_error(user, str(e))
             return False
 
+    def is_eligible(self, user, profile) -> bool:
+        return bool(self.client and profile and profile.phone_number)
+
+    def _is_provider_error(self, error) -> bool:
+        # 4xx от Twilio (например, неверный номер) относятся к получателю, а не к провайдеру
+        if isinstance(error, TwilioRestException) and error.status < 500:
+            return False
+        return True
+
+    @circuit_breaker
+    def _deliver(self, phone_number, body):
+        return self.client.messages.create(
+            body=body,
+            from_=settings.TWILIO_PHONE_NUMBER,
+            to=phone_number
+        )
+
     @property
     def channel_name(self):
         return "sms"
 
 class TelegramChannel(NotificationChannel):
-    def send(self, user, subject, message) -> bool:
-        from .models import UserProfile
-        profile = getattr(user, 'userprofile', None)
+    def send(self, user, profile, content, connection=None) -> bool:
         if not profile or not profile.telegram_chat_id:
             self._log_failure(user, "no Telegram chat ID")
             return False
         
-        bot_token = getattr(settings, 'TELEGRAM_BOT_TOKEN', None)
-        if not bot_token:
+        if not _TELEGRAM_BOT_TOKEN:
             self._log_failure(user, "Telegram bot token not configured")
             return False
         
         try:
-            full_message = f"*{subject}*\n{message}" if subject else message
+            logger.debug("Preparing to send Telegram message to chat %s", profile.telegram_chat_id)
             
-            logger.debug(f"📲 Preparing to send Telegram message to chat {profile.telegram_chat_id}")
-            
-            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
             payload = {
                 'chat_id': profile.telegram_chat_id,
-                'text': full_message,
+                'text': content,
                 'parse_mode': 'Markdown'
             }
             
-            response = requests.post(url, json=payload, timeout=10)
-            response_data = response.json()
+            response = self._deliver(payload)
             
-            if response.status_code == 200 and response_data.get('ok'):
-                self._log_success(user, f"to chat {profile.telegram_chat_id}")
+            # Telegram отвечает 200 только при ok=true - тело разбираем лишь при ошибке
+            if response.status_code == 200:
+                self._log_success(user, "to chat %s", profile.telegram_chat_id)
                 return True
-            else:
-                error_msg = response_data.get('description', 'Unknown error')
-                self._log_error(user, f"Telegram API: {error_msg}")
-                return False
+
+            response_data = orjson.loads(response.content)
+            error_msg = response_data.get('description', 'Unknown error')
+            self._log_error(user, f"Telegram API: {error_msg}")
+            return False
                 
-        except requests.exceptions.RequestException as e:
-            self._log_error(user, f"Network error: {e}")
+        except CircuitOpenError:
+            self._log_failure(user, "circuit breaker is open")
+            return False
+        except ProviderServerError as e:
+            self._log_error(user, f"Telegram server error: {e}")
+            return False
+        except httpx.HTTPError as e:
+            # str(e) может содержать URL запроса вместе с токеном бота
+            self._log_error(user, f"Network error: {type(e).__name__}")
             return False
         except Exception as e:
             self._log_error(user, str(e))
             return False
 
+    def prepare(self, subject, message):
+        return f"*{subject}*\n{message}" if subject else message
+
+    def is_eligible(self, user, profile) -> bool:
+        return bool(_TELEGRAM_BOT_TOKEN and profile and profile.telegram_chat_id)
+
+    @circuit_breaker
+    def _deliver(self, payload):
+        response = _TELEGRAM_CLIENT.post(
+            _TELEGRAM_URL,
+            content=orjson.dumps(payload),
+            headers=_TELEGRAM_HEADERS,
+        )
+        # Ошибки на стороне Telegram (5xx) учитываются предохранителем,
+        # ошибки запроса (например, неверный chat_id) - нет
+        if response.status_code >= 500:
+            raise ProviderServerError(response.status_code)
+        return response
+
     @property
     def channel_name(self):
-        return "telegram"
\ No newline at end of file
+        return "telegram"
+
+
+# Каналы по именам из settings.NOTIFICATION_CHANNELS
+CHANNEL_REGISTRY = {
+    'telegram': TelegramChannel,
+    'email': EmailChannel,
+    'sms': TwilioSMSChannel,
+}
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
 
 
 class UserProfile(models.Model):
@@ -7,6 +8,12 @@ class UserProfile(models.Model):
     phone_number = models.CharField(max_length=20, blank=True, null=True)
     telegram_chat_id = models.CharField(max_length=100, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['phone_number']),
+            models.Index(fields=['telegram_chat_id']),
+        ]
+
     def __str__(self):
         return f"{self.user.username} Profile"
 
@@ -25,5 +32,26 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     sent_at = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Уведомления пользователя по статусу, новые первыми
+            models.Index(fields=['user', 'status', '-created_at']),
+            # Статистика по статусам за период
+            models.Index(fields=['status', 'created_at']),
+        ]
+
     def __str__(self):
         return f"Notification to {self.user.username} - {self.status}"
+
+    @classmethod
+    def from_record(cls, record):
+        """Создает (не сохраняя) запись из NotificationService.get_notification_record()"""
+        sent_at = record.get('sent_at')
+        return cls(
+            user_id=record['user_id'],
+            subject=record['subject'],
+            message=record['message'],
+            status=record['status'],
+            sent_via=record['sent_via'],
+            sent_at=parse_datetime(sent_at) if sent_at else None,
+        )
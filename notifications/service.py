@@ -1,94 +1,284 @@
+import asyncio
 import logging
-from .channels import EmailChannel, TwilioSMSChannel, TelegramChannel
-from .models import Notification
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from .channels import CHANNEL_REGISTRY
+from .models import Notification, UserProfile
 
 logger = logging.getLogger(__name__)
 
+# Через сколько секунд без ответа текущего канала запускается следующий (send_async)
+HEDGE_DELAY = 1.0
+# Сколько секунд ждать ответа всех каналов в send_all_parallel
+PARALLEL_SEND_TIMEOUT = 15
+
+# Общий пул потоков процесса для параллельной отправки по каналам
+_CHANNEL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='notification-channel')
+
+
+class ProviderTransientError(Exception):
+    """Уведомление не доставлено ни одним каналом; отправку стоит повторить позже"""
+
+
+# Обратная связь User -> UserProfile (кэш select_related('userprofile'))
+_PROFILE_RELATION = UserProfile.user.field.remote_field
+
+
+def _get_profile(user):
+    """
+    Возвращает профиль пользователя или None.
+    Профиль, загруженный через select_related, берется из кэша без запроса;
+    в отличие от getattr(user, 'userprofile', None) не выбрасывает и не
+    перехватывает RelatedObjectDoesNotExist для пользователей без профиля.
+    """
+    if _PROFILE_RELATION.is_cached(user):
+        return _PROFILE_RELATION.get_cached_value(user)
+    return UserProfile.objects.filter(user=user).first()
+
+
+def _build_channels():
+    """Создает включенные в settings.NOTIFICATION_CHANNELS каналы в порядке приоритета"""
+    channels = []
+    for name in getattr(settings, 'NOTIFICATION_CHANNELS', CHANNEL_REGISTRY):
+        if name not in CHANNEL_REGISTRY:
+            raise ImproperlyConfigured(f"Unknown notification channel: {name!r}")
+        channels.append(CHANNEL_REGISTRY[name]())
+    return tuple(channels)
+
+
 class NotificationService:
     """
     Сервис для отправки уведомлений с резервными каналами.
     Реализует цепочку ответственности: если один канал не сработал, пробуем следующий.
     """
 
-    def __init__(self, user, subject, message):
+    # Каналы не хранят состояния, поэтому создаются один раз на процесс
+    # при первом обращении (см. get_channels), а не при импорте модуля
+    _channels = None
+
+    def __init__(self, user, subject, message, connections=None, prepared=None):
         self.user = user
         self.subject = subject
         self.message = message
-        # ПОРЯДОК ВАЖЕН: определяет приоритет каналов
-        self.channels = [
-            TelegramChannel(),    # Первый приоритет - быстрый и бесплатный
-            EmailChannel(),       # Второй приоритет - надежный
-            TwilioSMSChannel(),   # Третий приоритет - гарантированная доставка
-        ]
+        # Сообщение, отформатированное под каждый канал (см. prepare_payload)
+        self.prepared = prepared or self.prepare_payload(subject, message)
+        # Переиспользуемые соединения каналов, например {'email': connection} для рассылки
+        self.connections = connections or {}
+        # Профиль загружается один раз и передается во все каналы
+        self.profile = _get_profile(user)
+        # Каналы, для которых у пользователя нет адреса или нет настроек, пропускаем сразу
+        self.eligible_channels = []
+        self.skipped_channels = []
+        for channel in self.get_channels():
+            if channel.is_eligible(self.user, self.profile):
+                self.eligible_channels.append(channel)
+            else:
+                self.skipped_channels.append(channel.channel_name)
         self.last_successful_channel = None
+        # Все каналы, доставившие уведомление (несколько - в send_all_parallel)
+        self.successful_channels = []
         self.failed_channels = []  # Инициализируем список для неудачных попыток
+        self.sent_at = None
+
+    @classmethod
+    def get_channels(cls):
+        """Включенные каналы в порядке приоритета, создаются при первом вызове"""
+        if cls._channels is None:
+            cls._channels = _build_channels()
+        return cls._channels
+
+    @classmethod
+    def reset_channels(cls):
+        """Сбрасывает созданные каналы, следующий get_channels() прочитает настройки заново"""
+        cls._channels = None
+
+    @classmethod
+    def prepare_payload(cls, subject, message):
+        """
+        Форматирует сообщение для всех каналов: {channel_name: content}.
+        При рассылке вызывается один раз и передается в сервис каждого получателя.
+        """
+        return {
+            channel.channel_name: channel.prepare(subject, message)
+            for channel in cls.get_channels()
+        }
 
     def send(self) -> bool:
         """
         Пытается отправить уведомление через доступные каналы по цепочке.
         Возвращает True, если отправка прошла хотя бы через один канал.
+        В БД ничего не пишет - запись для журнала возвращает get_notification_record().
         """
-        # Создаем запись в БД о попытке отправки
-        notification = Notification.objects.create(
-            user=self.user,
-            subject=self.subject,
-            message=self.message,
-            status='pending'
-        )
-
-        logger.info(f"🚀 Starting notification delivery for user {self.user.username}")
-        logger.info(f"Available channels: {[ch.channel_name for ch in self.channels]}")
-        logger.info(f"Message: '{self.subject}' - '{self.message[:50]}...'")
+
+        logger.info("Starting notification delivery for user %s", self.user.username)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Available channels: %s", [ch.channel_name for ch in self.eligible_channels])
+            logger.debug("Message: '%s' - '%s...'", self.subject, self.message[:50])
 
         # Проходим по всем каналам по порядку
-        for channel in self.channels:
+        for channel in self.eligible_channels:
             channel_name = channel.channel_name
-            logger.info(f"🔄 Attempting to send via {channel_name}...")
+            logger.info("Attempting to send via %s...", channel_name)
             
-            try:
-                success = channel.send(self.user, self.subject, self.message)
-                
-                if success:
-                    # Успех! Сохраняем результат и завершаем цепочку
-                    notification.status = 'sent'
-                    notification.sent_via = channel_name
-                    notification.save()
-                    
-                    self.last_successful_channel = channel_name
-                    logger.info(f"✅ Notification successfully sent via {channel_name}")
-                    
-                    # Логируем информацию о пропущенных каналах
-                    if self.failed_channels:
-                        logger.info(f"📊 Skipped channels due to failures: {self.failed_channels}")
-                    
-                    return True
-                else:
-                    # Канал не сработал, пробуем следующий
-                    self.failed_channels.append(channel_name)
-                    logger.warning(f"❌ Channel {channel_name} failed, trying next...")
-                    
-            except Exception as e:
-                # Ошибка в канале, пробуем следующий
-                self.failed_channels.append(channel_name)
-                logger.error(f"💥 Channel {channel_name} error: {e}, trying next...")
-                continue
+            if self._try_channel(channel):
+                # Успех! Сохраняем результат и завершаем цепочку
+                self._mark_sent(channel_name)
+                return True
+
+            # Канал не сработал, пробуем следующий
+            self.failed_channels.append(channel_name)
 
         # Если дошли сюда - все каналы не сработали
-        notification.status = 'failed'
-        notification.save()
-        
-        logger.error(f"💔 All delivery channels failed for user {self.user.username}")
-        logger.error(f"Failed channels: {self.failed_channels}")
-        
+        self._mark_failed()
         return False
 
+    async def send_async(self, hedge_delay=HEDGE_DELAY) -> bool:
+        """
+        Асинхронная отправка с хеджированием: каналы запускаются по приоритету,
+        следующий стартует, если текущие не ответили за hedge_delay секунд или
+        завершились неудачей. Первый успешный канал завершает отправку.
+        Подходит для уведомлений, где допустима доставка сразу по нескольким каналам.
+        """
+        loop = asyncio.get_running_loop()
+        remaining = iter(self.eligible_channels)
+        running = {}
+
+        def start_next():
+            channel = next(remaining, None)
+            if channel is None:
+                return False
+            logger.info("Attempting to send via %s...", channel.channel_name)
+            # Каналы синхронные - выполняем их в пуле потоков
+            future = loop.run_in_executor(_CHANNEL_POOL, self._try_channel, channel)
+            running[future] = channel.channel_name
+            return True
+
+        start_next()
+        try:
+            while running:
+                done, _ = await asyncio.wait(
+                    set(running), timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Текущие каналы не успели ответить - подключаем следующий
+                    start_next()
+                    continue
+
+                # Сначала учитываем все завершившиеся каналы: если неудача обработается
+                # раньше успеха из того же done, start_next() запустит лишнюю отправку
+                succeeded = False
+                for future in done:
+                    channel_name = running.pop(future)
+                    if future.result():
+                        self._mark_sent(channel_name)
+                        succeeded = True
+                    else:
+                        self.failed_channels.append(channel_name)
+                if succeeded:
+                    return True
+
+                # Вместо каждого неудачного канала подключаем следующий
+                for _ in done:
+                    start_next()
+        finally:
+            # Отменяем ожидание проигравших каналов
+            # (уже начатая в потоке отправка завершится в фоне)
+            for future in running:
+                future.cancel()
+
+        self._mark_failed()
+        return False
+
+    def send_all_parallel(self, timeout=PARALLEL_SEND_TIMEOUT):
+        """
+        Отправляет уведомление сразу через все доступные каналы параллельно
+        (режим "все каналы" вместо цепочки fallback).
+        Возвращает словарь {channel_name: bool}.
+        """
+        logger.info("Starting parallel notification delivery for user %s", self.user.username)
+
+        futures = {
+            _CHANNEL_POOL.submit(self._try_channel, channel): channel.channel_name
+            for channel in self.eligible_channels
+        }
+        results = dict.fromkeys(futures.values(), False)
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                results[futures[future]] = future.result()
+        except FuturesTimeoutError:
+            logger.error("Channels did not respond within %s seconds", timeout)
+            for future in futures:
+                future.cancel()
+
+        # Итоги собираем в порядке приоритета каналов
+        for channel in self.eligible_channels:
+            if not results[channel.channel_name]:
+                self.failed_channels.append(channel.channel_name)
+        for channel in self.eligible_channels:
+            if results[channel.channel_name]:
+                self._mark_sent(channel.channel_name)
+
+        if self.last_successful_channel is None:
+            self._mark_failed()
+
+        return results
+
+    def _try_channel(self, channel) -> bool:
+        """Отправка через один канал; ошибки канала не пробрасываются"""
+        channel_name = channel.channel_name
+        try:
+            connection = self.connections.get(channel_name)
+            content = self.prepared[channel_name]
+            if channel.send(self.user, self.profile, content, connection):
+                return True
+            logger.warning("Channel %s failed, trying next...", channel_name)
+        except Exception as e:
+            logger.error("Channel %s error: %s, trying next...", channel_name, e)
+        return False
+
+    def _mark_sent(self, channel_name):
+        self.successful_channels.append(channel_name)
+        logger.info("Notification successfully sent via %s", channel_name)
+        if self.last_successful_channel is not None:
+            return
+
+        # Первый успешный канал - основной результат отправки
+        self.sent_at = timezone.now()
+        self.last_successful_channel = channel_name
+
+        # Логируем информацию о пропущенных каналах
+        if self.failed_channels:
+            logger.info("Skipped channels due to failures: %s", self.failed_channels)
+
+    def _mark_failed(self):
+        logger.error("All delivery channels failed for user %s", self.user.username)
+        logger.error("Failed channels: %s", self.failed_channels)
+
+    def get_notification_record(self):
+        """
+        Возвращает результат отправки для журнала уведомлений.
+        Словарь сериализуется в JSON и передается в Celery задачу записи.
+        """
+        return {
+            'user_id': self.user.pk,
+            'subject': self.subject,
+            'message': self.message,
+            'status': 'sent' if self.last_successful_channel else 'failed',
+            'sent_via': ','.join(self.successful_channels),
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
+
     def get_delivery_report(self):
         """Возвращает отчет о доставке"""
         return {
             'success': self.last_successful_channel is not None,
             'successful_channel': self.last_successful_channel,
+            'successful_channels': self.successful_channels,
             'failed_channels': self.failed_channels,
-            'total_channels_attempted': len(self.failed_channels) + (1 if self.last_successful_channel else 0)
+            'skipped_channels': self.skipped_channels,
+            'total_channels_attempted': len(self.failed_channels) + len(self.successful_channels)
         }
 
 def notify_user(user, subject, message):
@@ -98,4 +288,5 @@ def notify_user(user, subject, message):
     """
     service = NotificationService(user, subject, message)
     service.send()
+    Notification.from_record(service.get_notification_record()).save()
     return service
\ No newline at end of file
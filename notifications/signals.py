@@ -0,0 +1,26 @@
+from django.contrib.auth.models import User
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import UserProfile
+from .service import NotificationService
+from .tasks import _evict_cached_user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def _invalidate_user_cache(sender, instance, **kwargs):
+    """
+    Сбрасывает кэш пользователей в этом процессе (например, при отправке из
+    manage.py shell после правки профиля). Воркеры получают изменения по ttl кэша.
+    """
+    _evict_cached_user(instance.pk if sender is User else instance.user_id)
+
+
+@receiver(setting_changed)
+def _reset_notification_channels(setting, **kwargs):
+    """Пересоздает каналы после изменения NOTIFICATION_CHANNELS (override_settings в тестах)"""
+    if setting == 'NOTIFICATION_CHANNELS':
+        NotificationService.reset_channels()
@@ -1,54 +1,192 @@
-from celery import shared_task
-from celery.exceptions import MaxRetriesExceededError
+import asyncio
+import threading
+from cachetools import TTLCache
+from celery import group, shared_task
 from django.contrib.auth.models import User
-from .service import NotificationService
+from django.core import mail
+from .models import Notification
+from .service import NotificationService, ProviderTransientError
 import logging
 
 logger = logging.getLogger(__name__)
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=30)
-def send_notification_task(self, user_id, subject, message):
+# Кэш пользователей с профилями в процессе воркера. Устаревание данных ограничивает
+# ttl: правки из админки или веб-процесса попадают в воркер не позже чем через 60 секунд.
+# Сигналы (notifications/signals.py) сбрасывают запись только в процессе, сохранившем модель
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=60)
+_USER_CACHE_LOCK = threading.Lock()
+
+# Сколько получателей рассылки обрабатывает одна задача send_notification_batch_task
+BROADCAST_CHUNK_SIZE = 100
+
+
+def _get_user_cached(user_id):
+    """Возвращает пользователя с загруженным профилем, по возможности из кэша"""
+    with _USER_CACHE_LOCK:
+        user = _USER_CACHE.get(user_id)
+    if user is None:
+        user = User.objects.select_related('userprofile').get(id=user_id)
+        with _USER_CACHE_LOCK:
+            _USER_CACHE[user_id] = user
+    return user
+
+
+def _evict_cached_user(user_id):
+    """Удаляет пользователя из кэша текущего процесса"""
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(user_id, None)
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(ProviderTransientError,),
+    # Задержки 30, 60, 120, 240, 240 с (до jitter): повторы выходят за окно
+    # reset_timeout предохранителя каналов, а не упираются в разомкнутый канал
+    retry_backoff=30,
+    retry_backoff_max=240,
+    retry_jitter=True,
+    max_retries=5,
+    acks_late=True,
+)
+def send_notification_task(self, user_id, subject, message, hedged=False):
     """
-    Celery задача для отправки уведомлений с механизмом повторных попыток
+    Celery задача для отправки уведомлений с механизмом повторных попыток.
+    Если все каналы не сработали, задача повторяется с экспоненциальной задержкой.
+    hedged=True - резервные каналы запускаются параллельно с задержкой (send_async)
     """
     try:
-        user = User.objects.get(id=user_id)
-        logger.info(f"Starting notification task for user: {user.username}")
-        
-        service = NotificationService(user, subject, message)
-        success = service.send()
-        
-        if success:
-            logger.info(f"Notification successfully sent to user {user_id} via {service.last_successful_channel}")
-            return {
-                'status': 'success',
-                'user_id': user_id,
-                'username': user.username,
-                'channel': service.last_successful_channel,
-                'subject': subject
-            }
-        else:
-            # Если все каналы не сработали, повторяем задачу
-            logger.warning(f"All channels failed for user {user_id}, retrying...")
-            raise self.retry(countdown=60)  # Повтор через 60 секунд
-            
+        user = _get_user_cached(user_id)
     except User.DoesNotExist:
-        logger.error(f"User {user_id} not found in database")
+        # Повторять бессмысленно - пользователя нет
+        logger.error("User %s not found in database", user_id)
         return {
             'status': 'error', 
             'reason': 'user_not_found',
             'user_id': user_id
         }
-        
-    except Exception as e:
-        logger.error(f"Unexpected error in notification task: {e}")
-        try:
-            # Повторяем при неожиданных ошибках
-            raise self.retry(exc=e, countdown=30)
-        except MaxRetriesExceededError:
-            logger.error(f"Max retries exceeded for user {user_id}")
-            return {
-                'status': 'error', 
-                'reason': 'max_retries_exceeded',
-                'user_id': user_id
-            }
\ No newline at end of file
+
+    logger.info("Starting notification task for user: %s", user.username)
+    
+    service = NotificationService(user, subject, message)
+    if not service.eligible_channels:
+        # Повторять бессмысленно - без контактов или настроенных каналов
+        # результат не изменится
+        logger.error(
+            "No eligible channels for user %s, skipped: %s",
+            user_id, service.skipped_channels
+        )
+        record_notification_results.delay([service.get_notification_record()])
+        return {
+            'status': 'error',
+            'reason': 'no_eligible_channels',
+            'user_id': user_id
+        }
+
+    if hedged:
+        success = asyncio.run(service.send_async())
+    else:
+        success = service.send()
+
+    # Запись в журнал выполняется отдельной задачей в очереди аудита
+    record_notification_results.delay([service.get_notification_record()])
+    
+    if not success:
+        # Повтор выполнит autoretry_for
+        logger.warning("All channels failed for user %s, retrying...", user_id)
+        raise ProviderTransientError(f"All channels failed for user {user_id}")
+
+    logger.info("Notification successfully sent to user %s via %s", user_id, service.last_successful_channel)
+    return {
+        'status': 'success',
+        'user_id': user_id,
+        'username': user.username,
+        'channel': service.last_successful_channel,
+        'subject': subject
+    }
+
+@shared_task
+def send_notification_batch_task(user_ids, subject, message):
+    """
+    Celery задача для отправки одного уведомления группе пользователей.
+    Записи об отправке передаются в журнал одной задачей record_notification_results,
+    одно email-соединение (TLS, авторизация) переиспользуется для всех писем.
+    """
+    users = User.objects.filter(id__in=user_ids).select_related('userprofile')
+    records = []
+    sent_count = 0
+
+    # Соединение открывается при первом получателе, которому доступен email канал:
+    # если канал выключен, не настроен или ни у кого нет адреса - SMTP не трогаем
+    connection = None
+    connection_failed = False
+
+    prepared = NotificationService.prepare_payload(subject, message)
+
+    try:
+        for user in users:
+            service = NotificationService(user, subject, message, prepared=prepared)
+            if not connection_failed and any(
+                ch.channel_name == 'email' for ch in service.eligible_channels
+            ):
+                if connection is None:
+                    connection = mail.get_connection()
+                    try:
+                        connection.open()
+                    except Exception as e:
+                        # Email канал откроет соединение сам для каждого письма
+                        logger.warning("Could not open shared email connection: %s", e)
+                        connection = None
+                        connection_failed = True
+                service.connections['email'] = connection
+            if service.send():
+                sent_count += 1
+            records.append(service.get_notification_record())
+    finally:
+        if connection is not None:
+            connection.close()
+
+    record_notification_results.delay(records)
+    logger.info("Batch notification sent to %s of %s users", sent_count, len(records))
+
+    return {
+        'status': 'success',
+        'sent': sent_count,
+        'failed': len(records) - sent_count,
+        'subject': subject
+    }
+
+
+@shared_task
+def broadcast_notification_task(user_ids, subject, message):
+    """
+    Celery задача рассылки одного уведомления многим пользователям.
+    Получатели делятся на части по BROADCAST_CHUNK_SIZE, каждая часть
+    отправляется одной задачей send_notification_batch_task в группе.
+    """
+    chunks = [
+        user_ids[i:i + BROADCAST_CHUNK_SIZE]
+        for i in range(0, len(user_ids), BROADCAST_CHUNK_SIZE)
+    ]
+    group(
+        send_notification_batch_task.s(chunk, subject, message)
+        for chunk in chunks
+    ).apply_async()
+
+    logger.info("Broadcast to %s users split into %s batches", len(user_ids), len(chunks))
+    return {
+        'status': 'queued',
+        'users': len(user_ids),
+        'batches': len(chunks),
+        'subject': subject
+    }
+
+@shared_task(ignore_result=True)
+def record_notification_results(records):
+    """
+    Celery задача записи результатов отправки в журнал (модель Notification).
+    Выполняется в отдельной очереди notifications_audit, все записи - одним bulk_create.
+    """
+    Notification.objects.bulk_create(
+        [Notification.from_record(record) for record in records],
+        batch_size=500
+    )
@@ -0,0 +1,563 @@
+import asyncio
+import smtplib
+import threading
+from unittest import mock
+
+import httpx
+from anymail.exceptions import AnymailRecipientsRefused
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from twilio.base.exceptions import TwilioRestException
+
+from .channels import (
+    CircuitBreaker, CircuitOpenError, EmailChannel, EmailNotSentError, NotificationChannel,
+    TelegramChannel, TwilioSMSChannel,
+)
+from .models import UserProfile
+from .service import NotificationService, ProviderTransientError, _get_profile
+from .tasks import (
+    BROADCAST_CHUNK_SIZE, _USER_CACHE, _get_user_cached, broadcast_notification_task,
+    send_notification_batch_task, send_notification_task,
+)
+
+
+class PatchMixin:
+    """Патчи, которые снимаются автоматически после теста"""
+
+    def patch(self, target, *args, **kwargs):
+        patcher = mock.patch(target, *args, **kwargs)
+        mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocked
+
+    def patch_dict(self, target, *args, **kwargs):
+        patcher = mock.patch.dict(target, *args, **kwargs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def patch_clock(self, start=1000.0):
+        """Подменяет time.monotonic каналов; время двигается через self.now"""
+        self.now = start
+        self.patch('notifications.channels.time.monotonic', side_effect=lambda: self.now)
+
+    def reset_circuit_breakers(self):
+        """Свежий набор предохранителей на каждый тест"""
+        self.patch_dict('notifications.channels._CIRCUIT_BREAKERS', clear=True)
+
+
+class FakeChannel(NotificationChannel):
+    """Канал с заданным результатом; release задерживает отправку до события"""
+
+    def __init__(self, name, result=True, release=None):
+        self.name = name
+        self.result = result
+        self.release = release
+        self.calls = 0
+
+    @property
+    def channel_name(self):
+        return self.name
+
+    def send(self, user, profile, content, connection=None) -> bool:
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        return self.result
+
+
+class ServiceTestMixin(PatchMixin):
+    def make_service(self, *channels):
+        self.patch('notifications.service.NotificationService._channels', channels)
+        self.patch('notifications.service._get_profile', return_value=None)
+        return NotificationService(mock.Mock(username='test_user', pk=1), 'subject', 'message')
+
+
+class CircuitBreakerTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.patch_clock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def trip(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_allows_single_probe_after_reset_timeout(self):
+        self.trip()
+        self.now += 30
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # Пока пробная отправка не завершилась, остальные отклоняются
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.now += 30
+        self.breaker.allow_request()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.now += 30
+        self.breaker.allow_request()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+
+class ChannelCircuitBreakerTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.patch_clock()
+        self.reset_circuit_breakers()
+        client = self.patch('notifications.channels._get_twilio_client').return_value
+        self.channel = TwilioSMSChannel()
+        self.create = client.messages.create
+
+    def deliver(self):
+        return self.channel._deliver('+79123456789', 'text')
+
+    def twilio_error(self, status):
+        return TwilioRestException(status, 'https://api.twilio.com', msg='error', code=status)
+
+    def trip(self):
+        self.create.side_effect = self.twilio_error(503)
+        for _ in range(5):
+            with self.assertRaises(TwilioRestException):
+                self.deliver()
+
+    def test_provider_errors_open_circuit(self):
+        self.trip()
+        with self.assertRaises(CircuitOpenError):
+            self.deliver()
+
+    def test_recipient_errors_do_not_open_circuit(self):
+        self.create.side_effect = self.twilio_error(400)
+        for _ in range(10):
+            with self.assertRaises(TwilioRestException):
+                self.deliver()
+
+        self.create.side_effect = None
+        self.deliver()
+
+    def test_recipient_error_probe_closes_circuit(self):
+        self.trip()
+        self.now += 30
+
+        # Пробная отправка получила 4xx: провайдер работает
+        self.create.side_effect = self.twilio_error(400)
+        with self.assertRaises(TwilioRestException):
+            self.deliver()
+
+        self.create.side_effect = None
+        self.deliver()
+        self.assertEqual(self.create.call_count, 7)
+
+
+class EmailCircuitBreakerTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.patch_clock()
+        self.reset_circuit_breakers()
+        self.send_mail = self.patch('notifications.channels.send_mail', return_value=1)
+        self.channel = EmailChannel()
+        self.user = mock.Mock(email='user@example.com')
+
+    def deliver(self):
+        return self.channel._deliver(self.user, 'subject', 'message')
+
+    def test_provider_errors_open_circuit(self):
+        self.send_mail.side_effect = smtplib.SMTPServerDisconnected('connection closed')
+        for _ in range(5):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                self.deliver()
+        with self.assertRaises(CircuitOpenError):
+            self.deliver()
+
+    def test_recipient_errors_do_not_open_circuit(self):
+        recipient_errors = [
+            smtplib.SMTPRecipientsRefused({'user@example.com': (550, b'No such user')}),
+            AnymailRecipientsRefused(),
+        ]
+        for error in recipient_errors:
+            with self.subTest(error=type(error).__name__):
+                self.send_mail.side_effect = error
+                for _ in range(10):
+                    with self.assertRaises(type(error)):
+                        self.deliver()
+
+        # Бэкенд вернул 0 отправленных писем
+        self.send_mail.side_effect = None
+        self.send_mail.return_value = 0
+        for _ in range(10):
+            with self.assertRaises(EmailNotSentError):
+                self.deliver()
+
+        self.send_mail.return_value = 1
+        self.deliver()
+
+
+class TelegramChannelTests(PatchMixin, SimpleTestCase):
+    TOKEN = '123456:secret-token'
+    URL = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+
+    def setUp(self):
+        self.patch('notifications.channels._TELEGRAM_BOT_TOKEN', self.TOKEN)
+        self.patch('notifications.channels._TELEGRAM_URL', self.URL)
+        self.client = self.patch('notifications.channels._TELEGRAM_CLIENT')
+        self.reset_circuit_breakers()
+
+        self.channel = TelegramChannel()
+        self.user = mock.Mock(username='test_user')
+        self.profile = mock.Mock(telegram_chat_id='42')
+
+    def send(self):
+        return self.channel.send(self.user, self.profile, 'text')
+
+    def assertTokenNotLogged(self, logs):
+        self.assertTrue(logs.output)
+        for line in logs.output:
+            self.assertNotIn(self.TOKEN, line)
+
+    def test_server_error_does_not_log_token(self):
+        self.client.post.return_value = httpx.Response(
+            502, content=b'Bad Gateway', request=httpx.Request('POST', self.URL)
+        )
+        with self.assertLogs('notifications.channels', level='ERROR') as logs:
+            self.assertFalse(self.send())
+        self.assertTokenNotLogged(logs)
+
+    def test_network_error_does_not_log_token(self):
+        self.client.post.side_effect = httpx.ConnectError(
+            f"cannot connect to {self.URL}", request=httpx.Request('POST', self.URL)
+        )
+        with self.assertLogs('notifications.channels', level='ERROR') as logs:
+            self.assertFalse(self.send())
+        self.assertTokenNotLogged(logs)
+
+
+class BatchTaskEmailConnectionTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.eligible = []
+        users = self.patch('notifications.tasks.User')
+        self.users = users.objects.filter.return_value.select_related
+        self.patch('notifications.tasks.NotificationService', side_effect=self.make_service)
+        self.get_connection = self.patch('notifications.tasks.mail.get_connection')
+        self.patch('notifications.tasks.record_notification_results')
+
+    def make_service(self, user, subject, message, prepared=None):
+        service = mock.Mock(connections={})
+        service.eligible_channels = [mock.Mock(channel_name=name) for name in self.eligible]
+        service.send.return_value = True
+        return service
+
+    def run_batch(self, users_count, eligible):
+        self.eligible = eligible
+        self.users.return_value = [mock.Mock() for _ in range(users_count)]
+        return send_notification_batch_task(list(range(users_count)), 'subject', 'message')
+
+    def test_no_connection_without_email_recipients(self):
+        result = self.run_batch(3, ['sms', 'telegram'])
+        self.get_connection.assert_not_called()
+        self.assertEqual(result['sent'], 3)
+
+    def test_connection_opened_once_and_closed(self):
+        self.run_batch(3, ['email', 'sms'])
+        self.get_connection.assert_called_once()
+        connection = self.get_connection.return_value
+        connection.open.assert_called_once()
+        connection.close.assert_called_once()
+
+    def test_open_failure_is_not_retried(self):
+        self.get_connection.return_value.open.side_effect = OSError('connection refused')
+        with self.assertLogs('notifications.tasks', level='WARNING'):
+            result = self.run_batch(3, ['email'])
+        self.get_connection.assert_called_once()
+        self.get_connection.return_value.close.assert_not_called()
+        self.assertEqual(result['sent'], 3)
+
+
+class SendNotificationTaskTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.patch('notifications.tasks._get_user_cached')
+        self.service = self.patch('notifications.tasks.NotificationService').return_value
+        self.record = self.patch('notifications.tasks.record_notification_results')
+
+    def test_no_eligible_channels_is_not_retried(self):
+        self.service.eligible_channels = []
+        self.service.skipped_channels = ['email', 'sms', 'telegram']
+
+        with self.assertLogs('notifications.tasks', level='ERROR'):
+            result = send_notification_task.apply(args=(1, 'subject', 'message')).get()
+
+        self.assertEqual(result, {'status': 'error', 'reason': 'no_eligible_channels', 'user_id': 1})
+        self.service.send.assert_not_called()
+        self.record.delay.assert_called_once()
+
+    def test_channel_failure_is_retried(self):
+        self.service.eligible_channels = [mock.Mock(channel_name='email')]
+        self.service.send.return_value = False
+
+        with mock.patch.object(send_notification_task, 'retry', side_effect=ProviderTransientError) as retry:
+            with self.assertRaises(ProviderTransientError):
+                send_notification_task.apply(args=(1, 'subject', 'message'), throw=True).get()
+        retry.assert_called_once()
+
+    def test_retry_countdowns_outlast_circuit_breaker(self):
+        self.service.eligible_channels = [mock.Mock(channel_name='email')]
+        self.service.send.return_value = False
+
+        countdowns = []
+        # Без jitter: randrange(n + 1) -> n, то есть верхняя граница задержки
+        with mock.patch('celery.utils.time.random.randrange', side_effect=lambda n: n - 1), \
+                mock.patch.object(send_notification_task, 'retry', side_effect=ProviderTransientError) as retry:
+            for retries in range(send_notification_task.max_retries):
+                with self.assertRaises(ProviderTransientError):
+                    send_notification_task.apply(
+                        args=(1, 'subject', 'message'), retries=retries, throw=True
+                    ).get()
+                countdowns.append(retry.call_args.kwargs['countdown'])
+
+        self.assertEqual(countdowns, [30, 60, 120, 240, 240])
+        self.assertGreaterEqual(countdowns[0], CircuitBreaker().reset_timeout)
+
+
+class NotificationServiceSendTests(ServiceTestMixin, SimpleTestCase):
+    def test_chain_stops_at_first_success(self):
+        telegram, email, sms = FakeChannel('telegram', False), FakeChannel('email'), FakeChannel('sms')
+        service = self.make_service(telegram, email, sms)
+
+        self.assertTrue(service.send())
+        self.assertEqual(sms.calls, 0)
+        report = service.get_delivery_report()
+        self.assertEqual(report['successful_channels'], ['email'])
+        self.assertEqual(report['failed_channels'], ['telegram'])
+        self.assertEqual(report['total_channels_attempted'], 2)
+        self.assertEqual(service.get_notification_record()['sent_via'], 'email')
+
+    def test_parallel_records_every_successful_channel(self):
+        service = self.make_service(
+            FakeChannel('telegram', False), FakeChannel('email'), FakeChannel('sms')
+        )
+
+        results = service.send_all_parallel()
+
+        self.assertEqual(results, {'telegram': False, 'email': True, 'sms': True})
+        report = service.get_delivery_report()
+        self.assertEqual(report['successful_channel'], 'email')
+        self.assertEqual(report['successful_channels'], ['email', 'sms'])
+        self.assertEqual(report['failed_channels'], ['telegram'])
+        self.assertEqual(report['total_channels_attempted'], 3)
+        record = service.get_notification_record()
+        self.assertEqual(record['status'], 'sent')
+        self.assertEqual(record['sent_via'], 'email,sms')
+
+    def test_parallel_all_failed(self):
+        service = self.make_service(FakeChannel('email', False), FakeChannel('sms', False))
+
+        with self.assertLogs('notifications.service', level='ERROR'):
+            results = service.send_all_parallel()
+
+        self.assertEqual(results, {'email': False, 'sms': False})
+        record = service.get_notification_record()
+        self.assertEqual(record['status'], 'failed')
+        self.assertEqual(record['sent_via'], '')
+
+
+class SendAsyncTests(ServiceTestMixin, SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        # Зависшие каналы не должны держать потоки пула после теста
+        self.addCleanup(self.release.set)
+
+    def send_async(self, service, hedge_delay=0.05):
+        return asyncio.run(service.send_async(hedge_delay=hedge_delay))
+
+    def test_timeout_starts_next_channel(self):
+        telegram = FakeChannel('telegram', release=self.release)
+        email, sms = FakeChannel('email'), FakeChannel('sms')
+        service = self.make_service(telegram, email, sms)
+
+        self.assertTrue(self.send_async(service))
+
+        self.assertEqual(service.last_successful_channel, 'email')
+        self.assertEqual((telegram.calls, email.calls, sms.calls), (1, 1, 0))
+        # Результат получен, не дожидаясь зависшего канала
+        self.assertFalse(self.release.is_set())
+        self.assertEqual(service.failed_channels, [])
+
+    def test_failure_starts_next_channel_without_waiting(self):
+        telegram, email = FakeChannel('telegram', False), FakeChannel('email')
+        service = self.make_service(telegram, email)
+
+        # Задержка хеджирования больше таймаута теста: следующий канал
+        # запускается по неудаче, а не по времени
+        self.assertTrue(self.send_async(service, hedge_delay=60))
+
+        self.assertEqual(service.last_successful_channel, 'email')
+        self.assertEqual(service.failed_channels, ['telegram'])
+
+    def test_all_channels_failed(self):
+        service = self.make_service(FakeChannel('telegram', False), FakeChannel('email', False))
+
+        with self.assertLogs('notifications.service', level='ERROR'):
+            self.assertFalse(self.send_async(service))
+
+        self.assertIsNone(service.last_successful_channel)
+        self.assertEqual(service.failed_channels, ['telegram', 'email'])
+
+    def test_success_and_failure_together_start_no_extra_channel(self):
+        telegram = FakeChannel('telegram', False, release=self.release)
+        email, sms = FakeChannel('email'), FakeChannel('sms')
+        service = self.make_service(telegram, email, sms)
+        real_wait = asyncio.wait
+
+        async def wait(futures, timeout=None, return_when=None):
+            if len(futures) == 1:
+                return await real_wait(futures, timeout=timeout, return_when=return_when)
+            # Оба запущенных канала завершаются к одному и тому же asyncio.wait
+            self.release.set()
+            return await real_wait(futures, return_when=asyncio.ALL_COMPLETED)
+
+        with mock.patch('notifications.service.asyncio.wait', wait):
+            self.assertTrue(self.send_async(service))
+
+        self.assertEqual(sms.calls, 0)
+        self.assertEqual(service.last_successful_channel, 'email')
+        self.assertEqual(service.failed_channels, ['telegram'])
+
+
+class UserCacheTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        _USER_CACHE.clear()
+        self.addCleanup(_USER_CACHE.clear)
+        self.get = self.patch('notifications.tasks.User.objects.select_related').return_value.get
+        self.get.side_effect = lambda id: mock.Mock(pk=id)
+
+    def test_repeated_lookups_hit_cache(self):
+        user = _get_user_cached(1)
+        self.assertIs(_get_user_cached(1), user)
+        self.get.assert_called_once_with(id=1)
+
+    def test_user_save_evicts_entry(self):
+        user = _get_user_cached(1)
+        post_save.send(sender=User, instance=User(pk=1), created=False)
+        self.assertIsNot(_get_user_cached(1), user)
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_profile_save_evicts_owner(self):
+        _get_user_cached(1)
+        other = _get_user_cached(2)
+        post_save.send(sender=UserProfile, instance=UserProfile(user_id=1), created=False)
+        _get_user_cached(1)
+        self.assertIs(_get_user_cached(2), other)
+        self.assertEqual(self.get.call_count, 3)
+
+
+class ChannelSettingsTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        # Каналы, созданные в тесте, не должны остаться в классе
+        self.addCleanup(NotificationService.reset_channels)
+        NotificationService.reset_channels()
+        self.patch('notifications.channels._get_twilio_client')
+
+    def channel_names(self):
+        return [channel.channel_name for channel in NotificationService.get_channels()]
+
+    def test_channels_follow_setting_order(self):
+        with override_settings(NOTIFICATION_CHANNELS=['sms', 'email']):
+            self.assertEqual(self.channel_names(), ['sms', 'email'])
+        with override_settings(NOTIFICATION_CHANNELS=['telegram']):
+            self.assertEqual(self.channel_names(), ['telegram'])
+
+    def test_channels_are_built_once(self):
+        with override_settings(NOTIFICATION_CHANNELS=['email']):
+            self.assertIs(NotificationService.get_channels(), NotificationService.get_channels())
+
+    def test_unknown_channel_fails_on_first_use(self):
+        with override_settings(NOTIFICATION_CHANNELS=['email', 'pigeon']):
+            with self.assertRaises(ImproperlyConfigured):
+                NotificationService.get_channels()
+
+
+class BroadcastTaskTests(PatchMixin, SimpleTestCase):
+    def setUp(self):
+        self.group = self.patch('notifications.tasks.group')
+
+    def batches(self):
+        signatures = list(self.group.call_args.args[0])
+        for signature in signatures:
+            self.assertEqual(signature.task, send_notification_batch_task.name)
+        return [signature.args for signature in signatures]
+
+    def test_splits_recipients_into_chunks(self):
+        user_ids = list(range(BROADCAST_CHUNK_SIZE * 2 + 50))
+
+        result = broadcast_notification_task(user_ids, 'subject', 'message')
+
+        self.group.return_value.apply_async.assert_called_once_with()
+        self.assertEqual(self.batches(), [
+            (user_ids[:BROADCAST_CHUNK_SIZE], 'subject', 'message'),
+            (user_ids[BROADCAST_CHUNK_SIZE:BROADCAST_CHUNK_SIZE * 2], 'subject', 'message'),
+            (user_ids[BROADCAST_CHUNK_SIZE * 2:], 'subject', 'message'),
+        ])
+        self.assertEqual(result['users'], len(user_ids))
+        self.assertEqual(result['batches'], 3)
+
+    def test_small_broadcast_is_one_batch(self):
+        result = broadcast_notification_task([1, 2, 3], 'subject', 'message')
+
+        self.assertEqual(self.batches(), [([1, 2, 3], 'subject', 'message')])
+        self.assertEqual(result['batches'], 1)
+
+    def test_empty_broadcast_queues_nothing(self):
+        result = broadcast_notification_task([], 'subject', 'message')
+
+        self.assertEqual(self.batches(), [])
+        self.assertEqual(result['batches'], 0)
+
+
+class GetProfileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='with_profile')
+        cls.profile = UserProfile.objects.create(user=cls.user, phone_number='+79123456789')
+        User.objects.create(username='without_profile')
+
+    def test_select_related_profile_needs_no_query(self):
+        user = User.objects.select_related('userprofile').get(username='with_profile')
+        with self.assertNumQueries(0):
+            self.assertEqual(_get_profile(user), self.profile)
+
+    def test_select_related_missing_profile_needs_no_query(self):
+        user = User.objects.select_related('userprofile').get(username='without_profile')
+        with self.assertNumQueries(0):
+            self.assertIsNone(_get_profile(user))
+
+    def test_profile_is_queried_when_not_loaded(self):
+        user = User.objects.get(username='with_profile')
+        with self.assertNumQueries(1):
+            self.assertEqual(_get_profile(user), self.profile)
+
+    def test_missing_profile_is_queried_when_not_loaded(self):
+        user = User.objects.get(username='without_profile')
+        with self.assertNumQueries(1):
+            self.assertIsNone(_get_profile(user))
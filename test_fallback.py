@@ -244,27 +244,27 @@ def test_individual_channels():
     logging.info("\n🎯 INDIVIDUAL CHANNEL TESTS")
     logging.info("=" * 60)
     
-    user, _ = setup_test_user()
+    user, profile = setup_test_user()
     
     # Тест Email канала
     logging.info("\n1. 📧 Testing Email Channel")
     from notifications.channels import EmailChannel
     email_channel = EmailChannel()
-    email_result = email_channel.send(user, "Direct Email Test", "Testing email channel directly")
+    email_result = email_channel.send(user, profile, email_channel.prepare("Direct Email Test", "Testing email channel directly"))
     logging.info(f"   Email result: {'✅ Success' if email_result else '❌ Failed'}")
     
     # Тест Telegram канала
     logging.info("\n2. 📲 Testing Telegram Channel")
     from notifications.channels import TelegramChannel
     telegram_channel = TelegramChannel()
-    telegram_result = telegram_channel.send(user, "Direct Telegram Test", "Testing telegram channel directly")
+    telegram_result = telegram_channel.send(user, profile, telegram_channel.prepare("Direct Telegram Test", "Testing telegram channel directly"))
     logging.info(f"   Telegram result: {'✅ Success' if telegram_result else '❌ Failed'}")
     
     # Тест SMS канала
     logging.info("\n3. 📱 Testing SMS Channel")
     from notifications.channels import TwilioSMSChannel
     sms_channel = TwilioSMSChannel()
-    sms_result = sms_channel.send(user, "Direct SMS Test", "Testing SMS channel directly")
+    sms_result = sms_channel.send(user, profile, sms_channel.prepare("Direct SMS Test", "Testing SMS channel directly"))
     logging.info(f"   SMS result: {'✅ Success' if sms_result else '❌ Failed'}")
 
 if __name__ == "__main__":